@@ -12,8 +12,7 @@ Project website: http://blond.web.cern.ch/
 // Author: Danilo Quartullo, Konstantinos Iliakis
 
 
-#include "sin.h"
-#include "cos.h"
+#include "sincos.h"
 #include "exp.h"
 
 #include "openmp.h"
@@ -31,6 +30,11 @@ Project website: http://blond.web.cern.ch/
 
 using namespace vdt;
 
+// Number of time differences whose exponential and trigonometric terms are
+// computed together, before running the serial recurrence over them. The
+// block is small enough to stay in L1.
+const int MUSIC_BLOCK = 256;
+
 
 // Definition of struct particle
 template <typename T>
@@ -44,6 +48,241 @@ struct particle {
 };
 
 
+// Particle sorting with respect to dt
+template <typename T>
+static void sort_particles(T *__restrict__ beam_dt,
+                           T *__restrict__ beam_dE,
+                           const int n_macroparticles)
+{
+    std::vector<particle<T>> particles; particles.reserve(n_macroparticles);
+    for (int i = 0; i < n_macroparticles; i++)
+        particles.push_back({beam_dE[i], beam_dt[i]});
+#ifdef PARALLEL
+    __gnu_parallel::sort(particles.begin(), particles.end());
+#else
+    std::sort(particles.begin(), particles.end());
+#endif
+    for (int i = 0; i < n_macroparticles; i++) {
+        beam_dE[i] = particles[i].de;
+        beam_dt[i] = particles[i].dt;
+    }
+}
+
+
+// Products exp*cos and exp*sin of the MuSiC map for one time difference
+static inline void music_terms(const double time_difference,
+                               const double alpha,
+                               const double omega_bar,
+                               double &exp_cos, double &exp_sin)
+{
+    double sin_term, cos_term;
+    fast_sincos(omega_bar * time_difference, sin_term, cos_term);
+    const double exp_term = fast_exp(-alpha * time_difference);
+    exp_cos = exp_term * cos_term;
+    exp_sin = exp_term * sin_term;
+}
+
+
+static inline void music_terms(const float time_difference,
+                               const float alpha,
+                               const float omega_bar,
+                               float &exp_cos, float &exp_sin)
+{
+    float sin_term, cos_term;
+    fast_sincosf(omega_bar * time_difference, sin_term, cos_term);
+    const float exp_term = fast_expf(-alpha * time_difference);
+    exp_cos = exp_term * cos_term;
+    exp_sin = exp_term * sin_term;
+}
+
+
+template <typename T>
+static void music_block(const T *__restrict__ time_differences,
+                        T *__restrict__ beam_dE,
+                        T *__restrict__ induced_voltage,
+                        const int length,
+                        const T alpha,
+                        const T omega_bar,
+                        const T cnst,
+                        const T coeff1,
+                        const T coeff2,
+                        const T coeff3,
+                        const T coeff4,
+                        T &input_first_component,
+                        T &input_second_component)
+{
+    /*
+    MuSiC recurrence over at most MUSIC_BLOCK time differences, starting
+    from the given state vector, which is updated in place. beam_dE and
+    induced_voltage point to the particles reached by the time differences.
+
+    The exponential and trigonometric terms do not depend on the state, so
+    they are evaluated first in a loop without dependencies that the
+    compiler vectorises (structure of arrays, one lane per particle). Only
+    the 2x2 linear map is left in the serial loop.
+    */
+
+    T exp_cos[MUSIC_BLOCK];
+    T exp_sin[MUSIC_BLOCK];
+
+    for (int k = 0; k < length; k++)
+        music_terms(time_differences[k], alpha, omega_bar,
+                    exp_cos[k], exp_sin[k]);
+
+    for (int k = 0; k < length; k++) {
+        const T product_first_component =
+            (exp_cos[k] + coeff1 * exp_sin[k]) * input_first_component
+            + coeff2 * exp_sin[k] * input_second_component;
+
+        const T product_second_component =
+            coeff3 * exp_sin[k] * input_first_component
+            + (exp_cos[k] + coeff4 * exp_sin[k]) * input_second_component;
+
+        induced_voltage[k] = cnst * (0.5 + product_first_component);
+        beam_dE[k] += induced_voltage[k];
+        input_first_component = product_first_component + 1;
+        input_second_component = product_second_component;
+    }
+}
+
+
+template <typename T>
+static void music_sorted_beam(const T *__restrict__ beam_dt,
+                              T *__restrict__ beam_dE,
+                              T *__restrict__ induced_voltage,
+                              const int n_macroparticles,
+                              const T alpha,
+                              const T omega_bar,
+                              const T cnst,
+                              const T coeff1,
+                              const T coeff2,
+                              const T coeff3,
+                              const T coeff4,
+                              T &input_first_component,
+                              T &input_second_component)
+{
+    /*
+    MuSiC recurrence from the first to the last particle of a sorted beam,
+    starting from the given state vector, which is updated in place.
+    */
+
+    T time_differences[MUSIC_BLOCK];
+
+    for (int start = 0; start < n_macroparticles - 1; start += MUSIC_BLOCK) {
+        const int length = std::min(MUSIC_BLOCK,
+                                    n_macroparticles - 1 - start);
+
+        for (int k = 0; k < length; k++)
+            time_differences[k] = beam_dt[start + k + 1] - beam_dt[start + k];
+
+        music_block(time_differences, beam_dE + start + 1,
+                    induced_voltage + start + 1, length, alpha, omega_bar,
+                    cnst, coeff1, coeff2, coeff3, coeff4,
+                    input_first_component, input_second_component);
+    }
+}
+
+
+template <typename T>
+static void music_recurrence_impl(const T *__restrict__ time_differences,
+                                  T *__restrict__ beam_dE,
+                                  T *__restrict__ induced_voltage,
+                                  T *__restrict__ state,
+                                  const int n_differences,
+                                  const T alpha,
+                                  const T omega_bar,
+                                  const T cnst,
+                                  const T coeff1,
+                                  const T coeff2,
+                                  const T coeff3,
+                                  const T coeff4)
+{
+    for (int start = 0; start < n_differences; start += MUSIC_BLOCK)
+        music_block(time_differences + start, beam_dE + start,
+                    induced_voltage + start,
+                    std::min(MUSIC_BLOCK, n_differences - start), alpha,
+                    omega_bar, cnst, coeff1, coeff2, coeff3, coeff4,
+                    state[0], state[1]);
+}
+
+
+template <typename T>
+static void music_track_impl(T *__restrict__ beam_dt,
+                             T *__restrict__ beam_dE,
+                             T *__restrict__ induced_voltage,
+                             T *__restrict__ array_parameters,
+                             const int n_macroparticles,
+                             const T alpha,
+                             const T omega_bar,
+                             const T cnst,
+                             const T coeff1,
+                             const T coeff2,
+                             const T coeff3,
+                             const T coeff4)
+{
+    sort_particles(beam_dt, beam_dE, n_macroparticles);
+
+    // MuSiC algorithm
+    induced_voltage[0] = cnst / 2;
+    beam_dE[0] += induced_voltage[0];
+    T input_first_component = 1;
+    T input_second_component = 0;
+    music_sorted_beam(beam_dt, beam_dE, induced_voltage, n_macroparticles,
+                      alpha, omega_bar, cnst, coeff1, coeff2, coeff3, coeff4,
+                      input_first_component, input_second_component);
+
+    array_parameters[0] = input_first_component;
+    array_parameters[1] = input_second_component;
+    array_parameters[3] = beam_dt[n_macroparticles - 1];
+}
+
+
+template <typename T>
+static void music_track_multiturn_impl(T *__restrict__ beam_dt,
+                                       T *__restrict__ beam_dE,
+                                       T *__restrict__ induced_voltage,
+                                       T *__restrict__ array_parameters,
+                                       const int n_macroparticles,
+                                       const T alpha,
+                                       const T omega_bar,
+                                       const T cnst,
+                                       const T coeff1,
+                                       const T coeff2,
+                                       const T coeff3,
+                                       const T coeff4)
+{
+    sort_particles(beam_dt, beam_dE, n_macroparticles);
+
+    // First computation of MuSiC relative to the voltage coming from the
+    // previous turn
+    const T time_difference_0 = beam_dt[0] + array_parameters[2] - array_parameters[3];
+    T exp_cos, exp_sin;
+    music_terms(time_difference_0, alpha, omega_bar, exp_cos, exp_sin);
+
+    const T product_first_component =
+        (exp_cos + coeff1 * exp_sin) * array_parameters[0]
+        + coeff2 * exp_sin * array_parameters[1];
+
+    const T product_second_component =
+        coeff3 * exp_sin * array_parameters[0]
+        + (exp_cos + coeff4 * exp_sin) * array_parameters[1];
+
+    induced_voltage[0] = cnst * (0.5 + product_first_component);
+    beam_dE[0] += induced_voltage[0];
+    T input_first_component = product_first_component + 1;
+    T input_second_component = product_second_component;
+
+    // MuSiC algorithm for the current turn
+    music_sorted_beam(beam_dt, beam_dE, induced_voltage, n_macroparticles,
+                      alpha, omega_bar, cnst, coeff1, coeff2, coeff3, coeff4,
+                      input_first_component, input_second_component);
+
+    array_parameters[0] = input_first_component;
+    array_parameters[1] = input_second_component;
+    array_parameters[3] = beam_dt[n_macroparticles - 1];
+}
+
+
 extern "C" void music_track(double *__restrict__ beam_dt,
                             double *__restrict__ beam_dE,
                             double *__restrict__ induced_voltage,
@@ -84,51 +323,9 @@ extern "C" void music_track(double *__restrict__ beam_dt,
         Array of energies updated.
     */
 
-
-    // Particle sorting with respect to dt
-    std::vector<particle<double>> particles; particles.reserve(n_macroparticles);
-    for (int i = 0; i < n_macroparticles; i++)
-        particles.push_back({beam_dE[i], beam_dt[i]});
-#ifdef PARALLEL
-    __gnu_parallel::sort(particles.begin(), particles.end());
-#else
-    std::sort(particles.begin(), particles.end());
-#endif
-    for (int i = 0; i < n_macroparticles; i++) {
-        beam_dE[i] = particles[i].de;
-        beam_dt[i] = particles[i].dt;
-    }
-
-    // MuSiC algorithm
-    beam_dE[0] += induced_voltage[0];
-    double input_first_component = 1;
-    double input_second_component = 0;
-    for (int i = 0; i < n_macroparticles - 1; i++) {
-        const double time_difference = beam_dt[i + 1] - beam_dt[i];
-        const double exp_term = fast_exp(-alpha * time_difference);
-        const double cos_term = fast_cos(omega_bar * time_difference);
-        const double sin_term = fast_sin(omega_bar * time_difference);
-
-        const double product_first_component =
-            exp_term * ((cos_term + coeff1 * sin_term)
-                        * input_first_component + coeff2 * sin_term
-                        * input_second_component);
-
-        const double product_second_component =
-            exp_term * (coeff3 * sin_term * input_first_component
-                        + (cos_term + coeff4 * sin_term)
-                        * input_second_component);
-
-        induced_voltage[i + 1] = cnst * (0.5 + product_first_component);
-        beam_dE[i + 1] += induced_voltage[i + 1];
-        input_first_component = product_first_component + 1;
-        input_second_component = product_second_component;
-    }
-
-    array_parameters[0] = input_first_component;
-    array_parameters[1] = input_second_component;
-    array_parameters[3] = beam_dt[n_macroparticles - 1];
-
+    music_track_impl(beam_dt, beam_dE, induced_voltage, array_parameters,
+                     n_macroparticles, alpha, omega_bar, cnst,
+                     coeff1, coeff2, coeff3, coeff4);
 }
 
 
@@ -150,69 +347,10 @@ extern "C" void music_track_multiturn(double *__restrict__ beam_dt,
     Parameters and Returns as for music_track.
     */
 
-
-    // Particle sorting with respect to dt
-    std::vector<particle<double>> particles; particles.reserve(n_macroparticles);
-    for (int i = 0; i < n_macroparticles; i++)
-        particles.push_back({beam_dE[i], beam_dt[i]});
-#ifdef PARALLEL
-    __gnu_parallel::sort(particles.begin(), particles.end());
-#else
-    std::sort(particles.begin(), particles.end());
-#endif
-    for (int i = 0; i < n_macroparticles; i++) {
-        beam_dE[i] = particles[i].de;
-        beam_dt[i] = particles[i].dt;
-    }
-
-    // First computation of MuSiC relative to the voltage coming from the
-    // previous turn
-    const double time_difference_0 = beam_dt[0] + array_parameters[2] - array_parameters[3];
-    const double exp_term = fast_exp(-alpha * time_difference_0);
-    const double cos_term = fast_cos(omega_bar * time_difference_0);
-    const double sin_term = fast_sin(omega_bar * time_difference_0);
-
-    const double product_first_component =
-        exp_term * ((cos_term + coeff1 * sin_term)
-                    * array_parameters[0] + coeff2 * sin_term
-                    * array_parameters[1]);
-
-    const double product_second_component =
-        exp_term * (coeff3 * sin_term * array_parameters[0]
-                    + (cos_term + coeff4 * sin_term)
-                    * array_parameters[1]);
-
-    induced_voltage[0] = cnst * (0.5 + product_first_component);
-    beam_dE[0] += induced_voltage[0];
-    double input_first_component = product_first_component + 1;
-    double input_second_component = product_second_component;
-
-    // MuSiC algorithm for the current turn
-    for (int i = 0; i < n_macroparticles - 1; i++) {
-        const double time_difference = beam_dt[i + 1] - beam_dt[i];
-        const double exp_term = fast_exp(-alpha * time_difference);
-        const double cos_term = fast_cos(omega_bar * time_difference);
-        const double sin_term = fast_sin(omega_bar * time_difference);
-
-        const double product_first_component =
-            exp_term * ((cos_term + coeff1 * sin_term)
-                        * input_first_component + coeff2 * sin_term
-                        * input_second_component);
-
-        const double product_second_component =
-            exp_term * (coeff3 * sin_term * input_first_component
-                        + (cos_term + coeff4 * sin_term)
-                        * input_second_component);
-
-        induced_voltage[i + 1] = cnst * (0.5 + product_first_component);
-        beam_dE[i + 1] += induced_voltage[i + 1];
-        input_first_component = product_first_component + 1;
-        input_second_component = product_second_component;
-    }
-
-    array_parameters[0] = input_first_component;
-    array_parameters[1] = input_second_component;
-    array_parameters[3] = beam_dt[n_macroparticles - 1];
+    music_track_multiturn_impl(beam_dt, beam_dE, induced_voltage,
+                               array_parameters, n_macroparticles, alpha,
+                               omega_bar, cnst, coeff1, coeff2, coeff3,
+                               coeff4);
 }
 
 
@@ -231,77 +369,12 @@ extern "C" void music_trackf(float *__restrict__ beam_dt,
                              const float coeff4)
 {
     /*
-    This function calculates the single-turn induced voltage and updates the
-    energies of the particles.
-
-    Parameters
-    ----------
-    beam_dt : float array
-        Longitudinal coordinates [s]
-    beam_dE : float array
-        Initial energies [V]
-    induced_voltage : float array
-        array used to store the output of the computation
-    array_parameters : float array
-        See documentation in music.py
-    n_macroparticles : int
-        number of macro-particles
-    alpha, omega_bar, cnst, coeff1, coeff2, coeff3, coeff4 : floats
-        See documentation in music.py
-
-    Returns
-    -------
-    induced_voltage : float array
-        Computed induced voltage.
-    beam_dE : float array
-        Array of energies updated.
+    Single precision version of music_track.
     */
 
-
-    // Particle sorting with respect to dt
-    std::vector<particle<float>> particles; particles.reserve(n_macroparticles);
-    for (int i = 0; i < n_macroparticles; i++)
-        particles.push_back({beam_dE[i], beam_dt[i]});
-#ifdef PARALLEL
-    __gnu_parallel::sort(particles.begin(), particles.end());
-#else
-    std::sort(particles.begin(), particles.end());
-#endif
-    for (int i = 0; i < n_macroparticles; i++) {
-        beam_dE[i] = particles[i].de;
-        beam_dt[i] = particles[i].dt;
-    }
-
-    // MuSiC algorithm
-    beam_dE[0] += induced_voltage[0];
-    float input_first_component = 1;
-    float input_second_component = 0;
-    for (int i = 0; i < n_macroparticles - 1; i++) {
-        const float time_difference = beam_dt[i + 1] - beam_dt[i];
-        const float exp_term = fast_exp(-alpha * time_difference);
-        const float cos_term = fast_cos(omega_bar * time_difference);
-        const float sin_term = fast_sin(omega_bar * time_difference);
-
-        const float product_first_component =
-            exp_term * ((cos_term + coeff1 * sin_term)
-                        * input_first_component + coeff2 * sin_term
-                        * input_second_component);
-
-        const float product_second_component =
-            exp_term * (coeff3 * sin_term * input_first_component
-                        + (cos_term + coeff4 * sin_term)
-                        * input_second_component);
-
-        induced_voltage[i + 1] = cnst * (0.5 + product_first_component);
-        beam_dE[i + 1] += induced_voltage[i + 1];
-        input_first_component = product_first_component + 1;
-        input_second_component = product_second_component;
-    }
-
-    array_parameters[0] = input_first_component;
-    array_parameters[1] = input_second_component;
-    array_parameters[3] = beam_dt[n_macroparticles - 1];
-
+    music_track_impl(beam_dt, beam_dE, induced_voltage, array_parameters,
+                     n_macroparticles, alpha, omega_bar, cnst,
+                     coeff1, coeff2, coeff3, coeff4);
 }
 
 
@@ -318,75 +391,74 @@ extern "C" void music_track_multiturnf(float *__restrict__ beam_dt,
                                        const float coeff3,
                                        const float coeff4)
 {   /*
-    This function calculates the multi-turn induced voltage and updates the
-    energies of the particles.
-    Parameters and Returns as for music_track.
+    Single precision version of music_track_multiturn.
     */
 
+    music_track_multiturn_impl(beam_dt, beam_dE, induced_voltage,
+                               array_parameters, n_macroparticles, alpha,
+                               omega_bar, cnst, coeff1, coeff2, coeff3,
+                               coeff4);
+}
 
-    // Particle sorting with respect to dt
-    std::vector<particle<float>> particles; particles.reserve(n_macroparticles);
-    for (int i = 0; i < n_macroparticles; i++)
-        particles.push_back({beam_dE[i], beam_dt[i]});
-#ifdef PARALLEL
-    __gnu_parallel::sort(particles.begin(), particles.end());
-#else
-    std::sort(particles.begin(), particles.end());
-#endif
-    for (int i = 0; i < n_macroparticles; i++) {
-        beam_dE[i] = particles[i].de;
-        beam_dt[i] = particles[i].dt;
-    }
-
-    // First computation of MuSiC relative to the voltage coming from the
-    // previous turn
-    const float time_difference_0 = beam_dt[0] + array_parameters[2] - array_parameters[3];
-    const float exp_term = fast_exp(-alpha * time_difference_0);
-    const float cos_term = fast_cos(omega_bar * time_difference_0);
-    const float sin_term = fast_sin(omega_bar * time_difference_0);
-
-    const float product_first_component =
-        exp_term * ((cos_term + coeff1 * sin_term)
-                    * array_parameters[0] + coeff2 * sin_term
-                    * array_parameters[1]);
-
-    const float product_second_component =
-        exp_term * (coeff3 * sin_term * array_parameters[0]
-                    + (cos_term + coeff4 * sin_term)
-                    * array_parameters[1]);
 
-    induced_voltage[0] = cnst * (0.5 + product_first_component);
-    beam_dE[0] += induced_voltage[0];
-    float input_first_component = product_first_component + 1;
-    float input_second_component = product_second_component;
+extern "C" void music_recurrence(const double *__restrict__ time_differences,
+                                 double *__restrict__ beam_dE,
+                                 double *__restrict__ induced_voltage,
+                                 double *__restrict__ state,
+                                 const int n_differences,
+                                 const double alpha,
+                                 const double omega_bar,
+                                 const double cnst,
+                                 const double coeff1,
+                                 const double coeff2,
+                                 const double coeff3,
+                                 const double coeff4)
+{
+    /*
+    This function runs the MuSiC recurrence over precomputed time
+    differences of a sorted beam, without sorting. It is the compiled
+    counterpart of the recurrence of the Python methods.
 
-    // MuSiC algorithm for the current turn
-    for (int i = 0; i < n_macroparticles - 1; i++) {
-        const float time_difference = beam_dt[i + 1] - beam_dt[i];
-        const float exp_term = fast_exp(-alpha * time_difference);
-        const float cos_term = fast_cos(omega_bar * time_difference);
-        const float sin_term = fast_sin(omega_bar * time_difference);
-
-        const float product_first_component =
-            exp_term * ((cos_term + coeff1 * sin_term)
-                        * input_first_component + coeff2 * sin_term
-                        * input_second_component);
-
-        const float product_second_component =
-            exp_term * (coeff3 * sin_term * input_first_component
-                        + (cos_term + coeff4 * sin_term)
-                        * input_second_component);
-
-        induced_voltage[i + 1] = cnst * (0.5 + product_first_component);
-        beam_dE[i + 1] += induced_voltage[i + 1];
-        input_first_component = product_first_component + 1;
-        input_second_component = product_second_component;
-    }
+    Parameters
+    ----------
+    time_differences : float array
+        Time differences between consecutive particles [s]
+    beam_dE : float array
+        Energies of the particles reached by each time difference [V]
+    induced_voltage : float array
+        Induced voltage at the particles reached by each time difference
+    state : float array
+        The two components of the MuSiC state vector, updated in place
+    n_differences : int
+        Number of time differences
+    alpha, omega_bar, cnst, coeff1, coeff2, coeff3, coeff4 : floats
+        See documentation in music.py
+    */
 
-    array_parameters[0] = input_first_component;
-    array_parameters[1] = input_second_component;
-    array_parameters[3] = beam_dt[n_macroparticles - 1];
+    music_recurrence_impl(time_differences, beam_dE, induced_voltage, state,
+                          n_differences, alpha, omega_bar, cnst,
+                          coeff1, coeff2, coeff3, coeff4);
 }
 
 
+extern "C" void music_recurrencef(const float *__restrict__ time_differences,
+                                  float *__restrict__ beam_dE,
+                                  float *__restrict__ induced_voltage,
+                                  float *__restrict__ state,
+                                  const int n_differences,
+                                  const float alpha,
+                                  const float omega_bar,
+                                  const float cnst,
+                                  const float coeff1,
+                                  const float coeff2,
+                                  const float coeff3,
+                                  const float coeff4)
+{
+    /*
+    Single precision version of music_recurrence.
+    */
 
+    music_recurrence_impl(time_differences, beam_dE, induced_voltage, state,
+                          n_differences, alpha, omega_bar, cnst,
+                          coeff1, coeff2, coeff3, coeff4);
+}
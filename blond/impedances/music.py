@@ -13,11 +13,367 @@
 
 from __future__ import division
 from builtins import range, object
+import math
 import numpy as np
 from scipy.constants import e
 import ctypes
 from ..utils import bmath as bm
 
+from .. import libblond
+
+try:
+    from numba import cuda, float64, get_num_threads, njit, prange
+    _HAS_NUMBA = True
+except ImportError:
+    # numba is optional: without it the kernels run as plain Python
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+    prange = range
+
+    def get_num_threads():
+        return 1
+    cuda = None
+    _HAS_NUMBA = False
+
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
+
+
+def _aligned_empty(n, dtype, alignment=64):
+    r"""
+    Uninitialised 1D array whose data starts on an alignment-byte boundary,
+    so that the SIMD loads of the compiled loops are aligned.
+
+    """
+
+    itemsize = np.dtype(dtype).itemsize
+    buffer = np.empty(n*itemsize + alignment, dtype=np.uint8)
+    offset = -buffer.ctypes.data % alignment
+
+    return buffer[offset:offset+n*itemsize].view(dtype)
+
+
+@njit(fastmath=True, cache=True, boundscheck=False)
+def _music_map(exp_cos, exp_sin, coeff1, coeff2, coeff3, coeff4,
+               input_first_component, input_second_component):
+    r"""
+    Applies the 2x2 MuSiC map, built from the products exp*cos and exp*sin
+    of one time difference, to the state vector.
+
+    """
+
+    product_first_component = \
+        (exp_cos+coeff1*exp_sin)*input_first_component \
+        + coeff2*exp_sin*input_second_component
+    product_second_component = \
+        coeff3*exp_sin*input_first_component \
+        + (exp_cos+coeff4*exp_sin)*input_second_component
+
+    return product_first_component, product_second_component
+
+
+@njit(fastmath=True, cache=True, boundscheck=False)
+def _music_step(time_difference, alpha, omega_bar, coeff1, coeff2, coeff3,
+                coeff4, input_first_component, input_second_component):
+    r"""
+    Propagates the MuSiC state vector over one time difference and returns
+    the two components of the product, before the unit kick is added.
+
+    """
+
+    # One exponential and one sine/cosine pair per step; the 2x2 map only
+    # needs their products
+    exp_term = math.exp(-alpha * time_difference)
+    phase = omega_bar * time_difference
+
+    return _music_map(exp_term*math.cos(phase), exp_term*math.sin(phase),
+                      coeff1, coeff2, coeff3, coeff4, input_first_component,
+                      input_second_component)
+
+
+def _build_kernel(alpha, omega_bar, const, coeff1, coeff2, coeff3, coeff4):
+    r"""
+    Builds the MuSiC recurrence kernel for one set of constants. They are
+    captured by the closure, which numba compiles as immediates at the
+    first call, so that LLVM can fold them into the loop.
+
+    The kernel runs over the time differences between consecutive sorted
+    particles, starting from the given state vector. dE and induced_voltage
+    are the views on the particles reached by each time difference; the
+    final state vector is returned.
+
+    """
+
+    @njit(fastmath=True, boundscheck=False)
+    def kernel(time_differences, dE, induced_voltage, input_first_component,
+               input_second_component):
+
+        for i in range(len(time_differences)):
+
+            product_first_component, product_second_component = _music_step(
+                time_differences[i], alpha, omega_bar, coeff1, coeff2, coeff3,
+                coeff4, input_first_component, input_second_component)
+
+            # The kick uses the voltage before any rounding to the storage
+            # type
+            voltage = const*(0.5+product_first_component)
+            induced_voltage[i] = voltage
+            dE[i] += voltage
+
+            input_first_component = product_first_component+1.0
+            input_second_component = product_second_component
+
+        return input_first_component, input_second_component
+
+    return kernel
+
+
+def _music_terms(time_differences, alpha, omega_bar):
+    r"""
+    Products exp*cos and exp*sin of the MuSiC map for all the time
+    differences at once, evaluated by numexpr (multi-threaded) when it is
+    available and by numpy otherwise.
+
+    """
+
+    if ne is not None:
+        variables = {'tau': time_differences, 'alpha': alpha,
+                     'omega_bar': omega_bar}
+        variables['exp_term'] = ne.evaluate('exp(-alpha*tau)',
+                                            local_dict=variables)
+        exp_cos = ne.evaluate('exp_term*cos(omega_bar*tau)',
+                              local_dict=variables)
+        exp_sin = ne.evaluate('exp_term*sin(omega_bar*tau)',
+                              local_dict=variables)
+    else:
+        exp_term = np.exp(-alpha*time_differences)
+        phase = omega_bar*time_differences
+        exp_cos = exp_term*np.cos(phase)
+        exp_sin = exp_term*np.sin(phase)
+
+    return exp_cos, exp_sin
+
+
+@njit(fastmath=True, cache=True, boundscheck=False)
+def _music_scan(exp_cos, exp_sin, dE, induced_voltage, const, coeff1,
+                coeff2, coeff3, coeff4, input_first_component,
+                input_second_component):
+    r"""
+    MuSiC recurrence as built by _build_kernel, consuming precomputed
+    exp*cos and exp*sin products; the loop is left with multiplications and
+    additions.
+
+    """
+
+    for i in range(len(exp_cos)):
+
+        product_first_component, product_second_component = _music_map(
+            exp_cos[i], exp_sin[i], coeff1, coeff2, coeff3, coeff4,
+            input_first_component, input_second_component)
+
+        # The kick uses the voltage before any rounding to the storage type
+        voltage = const*(0.5+product_first_component)
+        induced_voltage[i] = voltage
+        dE[i] += voltage
+
+        input_first_component = product_first_component+1.0
+        input_second_component = product_second_component
+
+    return input_first_component, input_second_component
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _music_scan_parallel(exp_cos, exp_sin, dE, induced_voltage, const,
+                         coeff1, coeff2, coeff3, coeff4,
+                         input_first_component, input_second_component,
+                         n_chunks):
+    r"""
+    MuSiC recurrence as in _music_scan, parallelised over chunks of
+    particles. Each step is the affine map x -> M*x + (1, 0) of the state
+    vector, and affine maps compose associatively: the composed map of each
+    chunk is computed in parallel, the state entering each chunk follows
+    from a short serial scan over the chunks, and the chunks are finally
+    run in parallel from their entering state.
+
+    """
+
+    n_differences = len(exp_cos)
+    chunk_size = (n_differences + n_chunks - 1) // n_chunks
+
+    # Composed map A*x + b of each chunk, as (A11, A12, A21, A22, b1, b2)
+    chunk_maps = np.empty((n_chunks, 6))
+    for chunk in prange(n_chunks):
+        a11, a12, a21, a22, b1, b2 = 1.0, 0.0, 0.0, 1.0, 0.0, 0.0
+        for i in range(chunk*chunk_size,
+                       min((chunk+1)*chunk_size, n_differences)):
+            m11 = exp_cos[i]+coeff1*exp_sin[i]
+            m12 = coeff2*exp_sin[i]
+            m21 = coeff3*exp_sin[i]
+            m22 = exp_cos[i]+coeff4*exp_sin[i]
+            a11, a12, a21, a22 = m11*a11+m12*a21, m11*a12+m12*a22, \
+                m21*a11+m22*a21, m21*a12+m22*a22
+            b1, b2 = m11*b1+m12*b2+1.0, m21*b1+m22*b2
+        chunk_maps[chunk, 0] = a11
+        chunk_maps[chunk, 1] = a12
+        chunk_maps[chunk, 2] = a21
+        chunk_maps[chunk, 3] = a22
+        chunk_maps[chunk, 4] = b1
+        chunk_maps[chunk, 5] = b2
+
+    entering_states = np.empty((n_chunks, 2))
+    for chunk in range(n_chunks):
+        entering_states[chunk, 0] = input_first_component
+        entering_states[chunk, 1] = input_second_component
+        input_first_component, input_second_component = \
+            chunk_maps[chunk, 0]*input_first_component \
+            + chunk_maps[chunk, 1]*input_second_component \
+            + chunk_maps[chunk, 4], \
+            chunk_maps[chunk, 2]*input_first_component \
+            + chunk_maps[chunk, 3]*input_second_component \
+            + chunk_maps[chunk, 5]
+
+    for chunk in prange(n_chunks):
+        start = chunk*chunk_size
+        end = min(start+chunk_size, n_differences)
+        _music_scan(exp_cos[start:end], exp_sin[start:end], dE[start:end],
+                    induced_voltage[start:end], const, coeff1, coeff2,
+                    coeff3, coeff4, entering_states[chunk, 0],
+                    entering_states[chunk, 1])
+
+    return input_first_component, input_second_component
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _music_classic(dt, induced_voltage, alpha, omega_bar, coeff1, const,
+                   block_size=1024):
+    r"""
+    Induced voltage of a sorted beam from the basic O(n^2) definition. The
+    preceding particles are taken in blocks that fit in L1, each block being
+    reused by all the following particles; the sums of the different
+    particles are independent and are distributed over the threads.
+
+    """
+
+    n_macroparticles = len(dt)
+
+    for block_start in range(0, n_macroparticles, block_size):
+        block_end = min(block_start+block_size, n_macroparticles)
+
+        for i in prange(block_start+1, n_macroparticles):
+
+            accumulator = 0.0
+            for j in range(block_start, min(block_end, i)):
+                time_difference = dt[i]-dt[j]
+                phase = omega_bar * time_difference
+                accumulator += math.exp(-alpha * time_difference) * \
+                    (math.cos(phase)+coeff1*math.sin(phase))
+
+            # The first block initialises the sums
+            if block_start == 0:
+                induced_voltage[i] = accumulator
+            else:
+                induced_voltage[i] += accumulator
+
+    for i in prange(1, n_macroparticles):
+        induced_voltage[i] = const*(0.5+induced_voltage[i])
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _music_classic_lookup(dt, induced_voltage, table, inverse_step, const,
+                          block_size=1024):
+    r"""
+    As _music_classic, with the summand interpolated linearly in a table
+    sampled with constant step in the time difference. The summand is zero
+    beyond the end of the table.
+
+    """
+
+    n_macroparticles = len(dt)
+    last_sample = len(table) - 1
+
+    for block_start in range(0, n_macroparticles, block_size):
+        block_end = min(block_start+block_size, n_macroparticles)
+
+        for i in prange(block_start+1, n_macroparticles):
+
+            accumulator = 0.0
+            for j in range(block_start, min(block_end, i)):
+                position = (dt[i]-dt[j]) * inverse_step
+                k = int(position)
+                if k < last_sample:
+                    accumulator += table[k] + \
+                        (position-k)*(table[k+1]-table[k])
+
+            # The first block initialises the sums
+            if block_start == 0:
+                induced_voltage[i] = accumulator
+            else:
+                induced_voltage[i] += accumulator
+
+    for i in prange(1, n_macroparticles):
+        induced_voltage[i] = const*(0.5+induced_voltage[i])
+
+
+# Samples per radian of the fastest of the exponential and trigonometric
+# terms in the track_classic lookup table; the relative error of the linear
+# interpolation is about 1/(8*400**2), i.e. 1e-6
+_LOOKUP_SAMPLES_PER_RADIAN = 400
+
+# The lookup table stops where exp(-alpha*tau) falls below exp(-40), i.e.
+# 4e-18, and may not exceed 2**24 samples (128 MB)
+_LOOKUP_DECAY_EXPONENT = 40
+_LOOKUP_MAX_SAMPLES = 2**24
+
+# Minimum number of time differences for which the Python recurrence runs
+# as a parallel scan, and number of chunks of the scan per thread
+_PARALLEL_SCAN_THRESHOLD = 100000
+_PARALLEL_SCAN_CHUNKS_PER_THREAD = 4
+
+# Minimum number of macro-particles for which track_classic runs on the GPU,
+# and number of threads per block of the GPU kernel (a power of two)
+_GPU_CLASSIC_THRESHOLD = 10000
+_GPU_THREADS_PER_BLOCK = 256
+
+if cuda is not None:
+
+    @cuda.jit
+    def _music_classic_gpu(dt, induced_voltage, alpha, omega_bar, coeff1,
+                           const):
+        r"""
+        GPU version of _music_classic: each block computes the voltage at
+        one particle, its threads sharing the sum over the preceding
+        particles through a tree reduction in shared memory.
+
+        """
+
+        i = cuda.blockIdx.x + 1
+        thread = cuda.threadIdx.x
+
+        accumulator = 0.0
+        for j in range(thread, i, cuda.blockDim.x):
+            time_difference = dt[i]-dt[j]
+            phase = omega_bar * time_difference
+            accumulator += math.exp(-alpha * time_difference) * \
+                (math.cos(phase)+coeff1*math.sin(phase))
+
+        partial_sums = cuda.shared.array(_GPU_THREADS_PER_BLOCK, float64)
+        partial_sums[thread] = accumulator
+        cuda.syncthreads()
+
+        step = cuda.blockDim.x // 2
+        while step > 0:
+            if thread < step:
+                partial_sums[thread] += partial_sums[thread+step]
+            cuda.syncthreads()
+            step //= 2
+
+        if thread == 0:
+            induced_voltage[i] = const*(0.5+partial_sums[0])
+
 
 class Music(object):
 
@@ -43,6 +399,39 @@ class Music(object):
         Beam intensity [1].
     t_rev : float
         Revolution period [s]
+    batch_mode : bool
+        If True, the Python methods evaluate the exponential and
+        trigonometric terms of all the particles in one vectorised pass
+        (multi-threaded with numexpr, if installed) before running the
+        recurrence. Default is False.
+    dtype : numpy float type
+        Precision of the constants, of the induced voltage and of the time
+        differences in the Python recurrence; np.float32 halves the memory
+        traffic of the time differences and of the voltage, and evaluates
+        the exponential and trigonometric terms in single precision with
+        twice the SIMD width. The state vector of the recurrence is still
+        propagated in double precision, and the energies keep their own
+        type. Default is the BLonD precision (bm.precision.real_t), which
+        the C++ methods require.
+    voltage_dtype : numpy float type
+        Storage type of the induced voltage, e.g. np.float32 to halve the
+        memory traffic of its consumers. The recurrence of track_py and
+        track_py_multi_turn still runs in dtype and kicks the particles with
+        the unrounded voltage; track_classic kicks them with the stored
+        voltage. Default is dtype; the C++ methods require the BLonD
+        precision.
+    use_lookup : bool
+        If True, track_classic interpolates the exponential and
+        trigonometric terms in a precomputed table instead of evaluating
+        them, with an error of about 1e-6 on each term. The table holds
+        400*max(alpha, omega_bar) samples of 8 bytes per second of time
+        difference, over the spread of the beam in dt or the decay time of
+        the wake (40/alpha), whichever is shorter; above 2**24 samples
+        (128 MB) a RuntimeError is raised. Default is False.
+    assume_sorted : bool
+        If True, the Python methods take the beam as already sorted with
+        respect to dt and skip the check; the caller guarantees it.
+        Default is False.
 
     Attributes
     ----------
@@ -85,6 +474,17 @@ class Music(object):
     array_parameters : float array
         Array gathering four attributes already defined to be used in the C++
         algorithm.
+    batch_mode : bool
+        Evaluation of the terms of the Python recurrence in one vectorised
+        pass.
+    dtype : numpy float type
+        Working precision of the recurrence.
+    voltage_dtype : numpy float type
+        Storage type of the induced voltage.
+    use_lookup : bool
+        Use of the lookup table in track_classic.
+    assume_sorted : bool
+        Beam guaranteed to be sorted by the caller.
 
     Notes
     -----
@@ -100,7 +500,9 @@ class Music(object):
 
     """
 
-    def __init__(self, Beam, resonator, n_macroparticles, n_particles, t_rev):
+    def __init__(self, Beam, resonator, n_macroparticles, n_particles, t_rev,
+                 batch_mode=False, dtype=None, voltage_dtype=None,
+                 use_lookup=False, assume_sorted=False):
 
         self.beam = Beam
         self.R_S = resonator[0]
@@ -108,22 +510,179 @@ class Music(object):
         self.Q = resonator[2]
         self.n_macroparticles = n_macroparticles
         self.n_particles = n_particles
-        self.alpha = self.omega_R / (2*self.Q)
-        self.omega_bar = np.sqrt(self.omega_R ** 2 - self.alpha ** 2)
-        self.const = -e*self.R_S*self.omega_R * \
-            self.n_particles/(self.n_macroparticles*self.Q)
-        self.induced_voltage = np.zeros(len(self.beam.dt))
+        if dtype is None:
+            dtype = bm.precision.real_t
+        self.dtype = np.dtype(dtype).type
+        alpha = self.omega_R / (2*self.Q)
+        omega_bar = np.sqrt(self.omega_R ** 2 - alpha ** 2)
+        self.alpha = self.dtype(alpha)
+        self.omega_bar = self.dtype(omega_bar)
+        self.const = self.dtype(-e*self.R_S*self.omega_R *
+                                self.n_particles/(self.n_macroparticles*self.Q))
+        if voltage_dtype is None:
+            voltage_dtype = self.dtype
+        self.voltage_dtype = np.dtype(voltage_dtype).type
+        self.induced_voltage = _aligned_empty(len(self.beam.dt),
+                                              self.voltage_dtype)
+        self.induced_voltage[1:] = 0
         self.induced_voltage[0] = self.const/2
-        self.coeff1 = -self.alpha/self.omega_bar
-        self.coeff2 = -self.R_S*self.omega_R/(self.Q*self.omega_bar)
-        self.coeff3 = self.omega_R*self.Q/(self.R_S*self.omega_bar)
-        self.coeff4 = self.alpha/self.omega_bar
+        self.coeff1 = self.dtype(-alpha/omega_bar)
+        self.coeff2 = self.dtype(-self.R_S*self.omega_R/(self.Q*omega_bar))
+        self.coeff3 = self.dtype(self.omega_R*self.Q/(self.R_S*omega_bar))
+        self.coeff4 = self.dtype(alpha/omega_bar)
+        self._kernel = _build_kernel(self.alpha, self.omega_bar, self.const,
+                                     self.coeff1, self.coeff2, self.coeff3,
+                                     self.coeff4)
         self.input_first_component = 1
         self.input_second_component = 0
         self.t_rev = t_rev
         self.last_dt = self.beam.dt[-1]
         self.array_parameters = np.array([self.input_first_component,
-                                          self.input_second_component, self.t_rev, self.last_dt])
+                                          self.input_second_component, self.t_rev, self.last_dt],
+                                         dtype=self.dtype)
+        self.batch_mode = batch_mode
+        self._dt_buffer = _aligned_empty(len(self.beam.dt), self.beam.dt.dtype)
+        self._dE_buffer = _aligned_empty(len(self.beam.dE), self.beam.dE.dtype)
+        self._time_differences = _aligned_empty(len(self.beam.dt),
+                                                self.dtype)
+        self.assume_sorted = assume_sorted
+        self.use_lookup = use_lookup
+        if self.use_lookup:
+            self._build_lookup_table(np.max(self.beam.dt)
+                                     - np.min(self.beam.dt))
+
+    def _sort_beam(self):
+        r"""
+        Sorts the particles with respect to dt, unless they already are or
+        the beam is declared sorted (assume_sorted). The reordered
+        coordinates are gathered into preallocated buffers and copied back
+        into the beam arrays. Returns the time differences between
+        consecutive particles of the sorted beam, stored from the second
+        element of a preallocated buffer; the first one is left free for the
+        time difference to the previous turn.
+
+        """
+
+        dt = self.beam.dt
+        time_differences = self._time_differences[1:]
+        np.subtract(dt[1:], dt[:-1], out=time_differences)
+        if self.assume_sorted or \
+                np.minimum.reduce(time_differences, initial=0) >= 0:
+            return time_differences
+
+        # The beam arrays may be referenced by the caller: they are
+        # reordered in place rather than exchanged with the buffers
+        indices_sorted = np.argsort(dt, kind='stable')
+        np.take(dt, indices_sorted, out=self._dt_buffer, mode='clip')
+        np.take(self.beam.dE, indices_sorted, out=self._dE_buffer,
+                mode='clip')
+        dt[...] = self._dt_buffer
+        self.beam.dE[...] = self._dE_buffer
+
+        np.subtract(dt[1:], dt[:-1], out=time_differences)
+
+        return time_differences
+
+    def _build_lookup_table(self, span):
+        r"""
+        Tabulates the summand of track_classic,
+        exp(-alpha*tau)*(cos(omega_bar*tau)+coeff1*sin(omega_bar*tau)),
+        for time differences tau from 0 to span (with 10% margin), or up to
+        the time difference where the wake has decayed, beyond which the
+        summand is taken as zero.
+
+        """
+
+        alpha, omega_bar = float(self.alpha), float(self.omega_bar)
+        step = 1 / (max(alpha, omega_bar)*_LOOKUP_SAMPLES_PER_RADIAN)
+        decay_span = _LOOKUP_DECAY_EXPONENT / alpha
+        truncated = 1.1*span >= decay_span
+        table_span = decay_span if truncated else 1.1*span
+        n_samples = int(table_span/step) + 3
+        if n_samples > _LOOKUP_MAX_SAMPLES:
+            raise RuntimeError(
+                'ERROR in Music: the lookup table would need %d samples '
+                '(%.0f MB) for a span of %.3e s; the limit is %d, use '
+                'use_lookup=False' % (n_samples, 8e-6*n_samples, table_span,
+                                      _LOOKUP_MAX_SAMPLES))
+        tau = step * np.arange(n_samples)
+
+        self._lookup_table = np.exp(-alpha*tau) * \
+            (np.cos(omega_bar*tau) + float(self.coeff1)*np.sin(omega_bar*tau))
+        self._lookup_inverse_step = 1 / step
+        # Span of dt covered by the table; a truncated table covers any span
+        self._lookup_span = np.inf if truncated else table_span
+
+    def _recurrence(self, time_differences, dE, induced_voltage,
+                    input_first_component, input_second_component):
+        r"""
+        Runs the MuSiC recurrence of the Python methods over the given time
+        differences and returns the final state vector.
+
+        """
+
+        alpha, omega_bar, const = self.alpha, self.omega_bar, self.const
+        coeff1, coeff2, coeff3, coeff4 = \
+            self.coeff1, self.coeff2, self.coeff3, self.coeff4
+
+        # Without numba the kernels would be interpreted: the compiled
+        # recurrence of the C++ library is used instead when the types
+        # match its precision
+        if not _HAS_NUMBA and libblond is not None \
+                and self.dtype == bm.precision.real_t \
+                and dE.dtype == bm.precision.real_t \
+                and induced_voltage.dtype == bm.precision.real_t:
+            state = np.array([input_first_component, input_second_component],
+                             dtype=self.dtype)
+            bm.music_recurrence(time_differences, dE, induced_voltage, state,
+                                alpha, omega_bar, const, coeff1, coeff2,
+                                coeff3, coeff4)
+            return state[0], state[1]
+
+        # The scan doubles the work on the map, which pays off on long beams
+        # with several threads
+        if _HAS_NUMBA and len(time_differences) > _PARALLEL_SCAN_THRESHOLD \
+                and get_num_threads() > 1:
+            exp_cos, exp_sin = _music_terms(time_differences, alpha,
+                                            omega_bar)
+            return _music_scan_parallel(
+                exp_cos, exp_sin, dE, induced_voltage, const, coeff1, coeff2,
+                coeff3, coeff4, input_first_component, input_second_component,
+                _PARALLEL_SCAN_CHUNKS_PER_THREAD*get_num_threads())
+
+        if self.batch_mode:
+            exp_cos, exp_sin = _music_terms(time_differences, alpha,
+                                            omega_bar)
+            return _music_scan(exp_cos, exp_sin, dE, induced_voltage, const,
+                               coeff1, coeff2, coeff3, coeff4,
+                               input_first_component, input_second_component)
+
+        return self._kernel(time_differences, dE, induced_voltage,
+                            input_first_component, input_second_component)
+
+    def induced_voltage_f64(self):
+        r"""
+        Copy of the induced voltage in double precision, whatever its
+        storage type.
+
+        """
+
+        return self.induced_voltage.astype(np.float64)
+
+    def _check_cpp_types(self):
+        r"""
+        Checks that the constants and the induced voltage are in the BLonD
+        precision, the only one handled by the C++ methods.
+
+        """
+
+        if self.dtype != bm.precision.real_t \
+                or self.voltage_dtype != bm.precision.real_t:
+            raise TypeError(
+                'ERROR in Music: the C++ methods require dtype and '
+                'voltage_dtype to be the BLonD precision %s, got %s and %s'
+                % (np.dtype(bm.precision.real_t), np.dtype(self.dtype),
+                   np.dtype(self.voltage_dtype)))
 
     def track_cpp(self):
         r"""
@@ -141,6 +700,7 @@ class Music(object):
         >>> music_cpp.track_cpp()
 
         """
+        self._check_cpp_types()
         bm.music_track(self.beam.dt, self.beam.dE, self.induced_voltage,
                        self.array_parameters, self.alpha, self.omega_bar,
                        self.const, self.coeff1, self.coeff2, self.coeff3,
@@ -164,6 +724,7 @@ class Music(object):
         >>>     music_cpp.track_cpp_multi_turn()
 
         """
+        self._check_cpp_types()
         bm.music_track_multiturn(self.beam.dt, self.beam.dE, self.induced_voltage,
                                  self.array_parameters, self.alpha, self.omega_bar,
                                  self.const, self.coeff1, self.coeff2, self.coeff3,
@@ -185,36 +746,18 @@ class Music(object):
 
         """
 
-        indices_sorted = np.argsort(self.beam.dt)
-        self.beam.dt = self.beam.dt[indices_sorted]
-        self.beam.dE = self.beam.dE[indices_sorted]
-        self.beam.dE[0] += self.induced_voltage[0]
-        self.input_first_component = 1
-        self.input_second_component = 0
-
-        for i in range(len(self.beam.dt)-1):
-
-            time_difference = self.beam.dt[i+1]-self.beam.dt[i]
+        time_differences = self._sort_beam()
+        dt, dE = self.beam.dt, self.beam.dE
+        induced_voltage = self.induced_voltage
 
-            exp_term = np.exp(-self.alpha * time_difference)
-            cos_term = np.cos(self.omega_bar * time_difference)
-            sin_term = np.sin(self.omega_bar * time_difference)
+        induced_voltage[0] = self.const/2
+        dE[0] += self.const/2
+        input_first_component, input_second_component = self._recurrence(
+            time_differences, dE[1:], induced_voltage[1:], 1.0, 0.0)
 
-            product_first_component = exp_term * \
-                ((cos_term+self.coeff1*sin_term)*self.input_first_component
-                 + self.coeff2*sin_term*self.input_second_component)
-            product_second_component = exp_term * \
-                (self.coeff3*sin_term*self.input_first_component
-                 + (cos_term+self.coeff4*sin_term)*self.input_second_component)
-
-            self.induced_voltage[i+1] = self.const * \
-                (0.5+product_first_component)
-            self.beam.dE[i+1] += self.induced_voltage[i+1]
-
-            self.input_first_component = product_first_component+1.0
-            self.input_second_component = product_second_component
-
-        self.last_dt = self.beam.dt[-1]
+        self.input_first_component = input_first_component
+        self.input_second_component = input_second_component
+        self.last_dt = dt[-1]
 
     def track_py_multi_turn(self):
         r"""
@@ -234,72 +777,52 @@ class Music(object):
 
         """
 
-        indices_sorted = np.argsort(self.beam.dt)
-        self.beam.dt = self.beam.dt[indices_sorted]
-        self.beam.dE = self.beam.dE[indices_sorted]
-        time_difference_0 = self.beam.dt[0] + self.t_rev - self.last_dt
-        exp_term = np.exp(-self.alpha * time_difference_0)
-        cos_term = np.cos(self.omega_bar * time_difference_0)
-        sin_term = np.sin(self.omega_bar * time_difference_0)
-        product_first_component = exp_term * \
-            ((cos_term+self.coeff1*sin_term)*self.input_first_component
-             + self.coeff2*sin_term*self.input_second_component)
-        product_second_component = exp_term * \
-            (self.coeff3*sin_term*self.input_first_component
-             + (cos_term+self.coeff4*sin_term)*self.input_second_component)
-        self.induced_voltage[0] = self.const * \
-            (0.5+product_first_component)
-        self.beam.dE[0] += self.induced_voltage[0]
-        self.input_first_component = product_first_component+1.0
-        self.input_second_component = product_second_component
-
-        for i in range(len(self.beam.dt)-1):
-
-            time_difference = self.beam.dt[i+1]-self.beam.dt[i]
-
-            exp_term = np.exp(-self.alpha * time_difference)
-            cos_term = np.cos(self.omega_bar * time_difference)
-            sin_term = np.sin(self.omega_bar * time_difference)
-
-            product_first_component = exp_term * \
-                ((cos_term+self.coeff1*sin_term)*self.input_first_component
-                 + self.coeff2*sin_term*self.input_second_component)
-            product_second_component = exp_term * \
-                (self.coeff3*sin_term*self.input_first_component
-                 + (cos_term+self.coeff4*sin_term)*self.input_second_component)
-
-            self.induced_voltage[i+1] = self.const * \
-                (0.5+product_first_component)
-            self.beam.dE[i+1] += self.induced_voltage[i+1]
-
-            self.input_first_component = product_first_component+1.0
-            self.input_second_component = product_second_component
+        self._sort_beam()
+        dt, dE = self.beam.dt, self.beam.dE
+        induced_voltage = self.induced_voltage
 
-        self.last_dt = self.beam.dt[-1]
+        # The last particle of the previous turn acts as a virtual particle
+        # preceding the beam, so that a single recurrence covers all the
+        # particles
+        time_differences = self._time_differences
+        time_differences[0] = dt[0] + self.t_rev - self.last_dt
+
+        input_first_component, input_second_component = self._recurrence(
+            time_differences, dE, induced_voltage,
+            self.input_first_component, self.input_second_component)
+
+        self.input_first_component = input_first_component
+        self.input_second_component = input_second_component
+        self.last_dt = dt[-1]
 
     def track_classic(self):
         r"""
-        Voltage in time domain using the basic definition (Python code)
+        Voltage in time domain using the basic definition (Python code,
+        compiled and multi-threaded when numba is available, and run on the
+        GPU for large beams when CUDA is available)
 
         """
 
-        indices_sorted = np.argsort(self.beam.dt)
-        self.beam.dt = self.beam.dt[indices_sorted]
-        self.beam.dE = self.beam.dE[indices_sorted]
-        self.beam.dE[0] += self.induced_voltage[0]
-        self.induced_voltage[1:] = 0
-
-        for i in range(len(self.beam.dt)-1):
-
-            for j in range(i+1):
-
-                time_difference = self.beam.dt[i+1]-self.beam.dt[j]
-                exp_term = np.exp(-self.alpha * time_difference)
-                cos_term = np.cos(self.omega_bar * time_difference)
-                sin_term = np.sin(self.omega_bar * time_difference)
-                self.induced_voltage[i+1] += \
-                    exp_term*(cos_term+self.coeff1*sin_term)
-
-            self.induced_voltage[i+1] = \
-                self.const*(0.5+self.induced_voltage[i+1])
-            self.beam.dE[i+1] += self.induced_voltage[i+1]
+        self._sort_beam()
+        dt, dE = self.beam.dt, self.beam.dE
+        induced_voltage = self.induced_voltage
+
+        if self.use_lookup:
+            if dt[-1]-dt[0] > self._lookup_span:
+                self._build_lookup_table(dt[-1]-dt[0])
+            _music_classic_lookup(dt, induced_voltage, self._lookup_table,
+                                  self._lookup_inverse_step, self.const)
+        elif len(dt) > _GPU_CLASSIC_THRESHOLD and cuda is not None \
+                and cuda.is_available():
+            # The kernel only writes the voltage from the second particle
+            # on: nothing is uploaded and the first value stays on the host
+            dt_device = cuda.to_device(dt)
+            voltage_device = cuda.device_array_like(induced_voltage)
+            _music_classic_gpu[len(dt)-1, _GPU_THREADS_PER_BLOCK](
+                dt_device, voltage_device, self.alpha, self.omega_bar,
+                self.coeff1, self.const)
+            voltage_device[1:].copy_to_host(induced_voltage[1:])
+        else:
+            _music_classic(dt, induced_voltage, self.alpha, self.omega_bar,
+                           self.coeff1, self.const)
+        dE += induced_voltage
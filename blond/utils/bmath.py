@@ -54,6 +54,7 @@ _CPU_func_dict = {
     'slice_smooth': butils_wrap.slice_smooth,
     'music_track': butils_wrap.music_track,
     'music_track_multiturn': butils_wrap.music_track_multiturn,
+    'music_recurrence': butils_wrap.music_recurrence,
     'diff': np.diff,
     'cumsum': np.cumsum,
     'cumprod': np.cumprod,
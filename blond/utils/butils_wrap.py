@@ -933,6 +933,42 @@ def music_track_multiturn(dt, dE, induced_voltage, array_parameters,
                                     __c_real(coeff4))
 
 
+def music_recurrence(time_differences, dE, induced_voltage, state,
+                     alpha, omega_bar,
+                     const, coeff1, coeff2, coeff3, coeff4):
+    assert time_differences.dtype == precision.real_t
+    assert dE.dtype == precision.real_t
+    assert induced_voltage.dtype == precision.real_t
+    assert state.dtype == precision.real_t
+
+    if precision.num == 1:
+        __lib.music_recurrencef(__getPointer(time_differences),
+                                __getPointer(dE),
+                                __getPointer(induced_voltage),
+                                __getPointer(state),
+                                __getLen(time_differences),
+                                __c_real(alpha),
+                                __c_real(omega_bar),
+                                __c_real(const),
+                                __c_real(coeff1),
+                                __c_real(coeff2),
+                                __c_real(coeff3),
+                                __c_real(coeff4))
+    else:
+        __lib.music_recurrence(__getPointer(time_differences),
+                               __getPointer(dE),
+                               __getPointer(induced_voltage),
+                               __getPointer(state),
+                               __getLen(time_differences),
+                               __c_real(alpha),
+                               __c_real(omega_bar),
+                               __c_real(const),
+                               __c_real(coeff1),
+                               __c_real(coeff2),
+                               __c_real(coeff3),
+                               __c_real(coeff4))
+
+
 def synchrotron_radiation(dE, U0, n_kicks, tau_z):
     assert isinstance(dE[0], precision.real_t)
     # dE = dE.astype(dtype=precision.real_t, order='C', copy=False)
@@ -0,0 +1,341 @@
+# coding: utf8
+# Copyright 2014-2017 CERN. This software is distributed under the
+# terms of the GNU General Public Licence version 3 (GPL Version 3),
+# copied verbatim in the file LICENCE.md.
+# In applying this licence, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as an Intergovernmental Organization or
+# submit itself to any jurisdiction.
+# Project website: http://blond.web.cern.ch/
+
+"""
+Unittest for impedances.music
+
+"""
+
+import unittest
+from unittest import mock
+import numpy as np
+
+from blond.input_parameters.ring import Ring
+from blond.beam.beam import Beam, Proton
+from blond.impedances import music as musicModule
+from blond.impedances.music import Music
+
+
+class TestMusic(unittest.TestCase):
+
+    def setUp(self):
+
+        self.n_macroparticles = 300
+        self.n_particles = 1e11
+        self.t_rev = 2e-8
+        self.resonator = [1e7, 2*np.pi*1e8, 1]
+
+        self.ring = Ring(2*np.pi*25, 1/4.076750841**2, 13e9, Proton(), 1)
+
+        np.random.seed(1000)
+        self.dt_first = 1e-8*np.random.rand(self.n_macroparticles)
+        self.dt_second = 1e-8*np.random.rand(self.n_macroparticles)
+
+    def _music(self, dt, **kwargs):
+
+        beam = Beam(self.ring, len(dt), self.n_particles)
+        beam.dt = dt.copy()
+        beam.dE = np.zeros(len(dt))
+
+        return Music(beam, self.resonator, self.n_macroparticles,
+                     self.n_particles, self.t_rev, **kwargs)
+
+    def _assert_voltage_close(self, voltage, reference):
+
+        np.testing.assert_allclose(voltage, reference, rtol=1e-7,
+                                   atol=1e-7*np.max(np.abs(reference)))
+
+    def test_track_py_against_classic(self):
+
+        music = self._music(self.dt_first)
+        music.track_py()
+        reference = self._music(self.dt_first)
+        reference.track_classic()
+
+        np.testing.assert_equal(music.beam.dt, reference.beam.dt)
+        self._assert_voltage_close(music.induced_voltage,
+                                   reference.induced_voltage)
+        self._assert_voltage_close(music.beam.dE, reference.beam.dE)
+
+    @unittest.skipUnless(musicModule.cuda is not None
+                         and musicModule.cuda.is_available(),
+                         'CUDA is not available')
+    def test_track_classic_gpu(self):
+
+        music = self._music(self.dt_first)
+        with mock.patch.object(musicModule, '_GPU_CLASSIC_THRESHOLD', 0):
+            music.track_classic()
+        reference = self._music(self.dt_first)
+        reference.track_classic()
+
+        self._assert_voltage_close(music.induced_voltage,
+                                   reference.induced_voltage)
+        self._assert_voltage_close(music.beam.dE, reference.beam.dE)
+
+    def test_classic_blocks(self):
+
+        music = self._music(self.dt_first, use_lookup=True)
+        dt = np.sort(self.dt_first)
+
+        # Several blocks of preceding particles against a single one
+        for kernel, arguments in [
+                (musicModule._music_classic,
+                 (music.alpha, music.omega_bar, music.coeff1, music.const)),
+                (musicModule._music_classic_lookup,
+                 (music._lookup_table, music._lookup_inverse_step,
+                  music.const))]:
+            voltage = np.zeros(self.n_macroparticles)
+            kernel(dt, voltage, *arguments, 7)
+            reference = np.zeros(self.n_macroparticles)
+            kernel(dt, reference, *arguments, 1024)
+
+            self._assert_voltage_close(voltage, reference)
+
+    def test_track_classic_lookup(self):
+
+        music = self._music(self.dt_first, use_lookup=True)
+        music.track_classic()
+        reference = self._music(self.dt_first)
+        reference.track_classic()
+
+        np.testing.assert_allclose(
+            music.induced_voltage, reference.induced_voltage, rtol=1e-5,
+            atol=1e-5*np.max(np.abs(reference.induced_voltage)))
+
+    def test_track_classic_lookup_truncated(self):
+
+        # The beam spreads over several decay times of the wake
+        dt = 1e-6*np.random.rand(self.n_macroparticles)
+        music = self._music(dt, use_lookup=True)
+        music.track_classic()
+        reference = self._music(dt)
+        reference.track_classic()
+
+        self.assertLess(len(music._lookup_table),
+                        1e-6*music._lookup_inverse_step)
+        np.testing.assert_allclose(
+            music.induced_voltage, reference.induced_voltage, rtol=1e-5,
+            atol=1e-5*np.max(np.abs(reference.induced_voltage)))
+
+    def test_lookup_table_size_limit(self):
+
+        with mock.patch.object(musicModule, '_LOOKUP_MAX_SAMPLES', 1000):
+            with self.assertRaises(RuntimeError):
+                self._music(self.dt_first, use_lookup=True)
+
+    def test_sort_beam(self):
+
+        music = self._music(self.dt_first)
+        music.beam.dE = 1e9*self.dt_first
+        music._sort_beam()
+
+        np.testing.assert_equal(music.beam.dt, np.sort(self.dt_first))
+        np.testing.assert_equal(music.beam.dE, 1e9*music.beam.dt)
+
+        # An already sorted beam is left untouched
+        sorted_dt = music.beam.dt
+        time_differences = music._sort_beam()
+        self.assertIs(music.beam.dt, sorted_dt)
+        np.testing.assert_equal(time_differences, np.diff(sorted_dt))
+
+    def test_sort_beam_keeps_previous_arrays(self):
+
+        music = self._music(self.dt_first)
+        previous_dt, previous_dE = music.beam.dt, music.beam.dE
+        music.track_py()
+        saved_dt, saved_dE = previous_dt.copy(), previous_dE.copy()
+
+        # The arrays handed over by the caller are not reused as buffers
+        music.beam.dt = self.dt_second.copy()
+        music.beam.dE = np.zeros(self.n_macroparticles)
+        music.track_py_multi_turn()
+
+        np.testing.assert_equal(previous_dt, saved_dt)
+        np.testing.assert_equal(previous_dE, saved_dE)
+
+    def test_assume_sorted(self):
+
+        music = self._music(self.dt_first, assume_sorted=True)
+        music._sort_beam()
+
+        np.testing.assert_equal(music.beam.dt, self.dt_first)
+
+    def test_track_py_multi_turn_against_classic(self):
+
+        music = self._music(self.dt_first)
+        music.track_py()
+        music.beam.dt = self.dt_second.copy()
+        music.beam.dE = np.zeros(self.n_macroparticles)
+        music.track_py_multi_turn()
+
+        # The previous turn acts as a leading train of particles
+        reference = self._music(np.concatenate(
+            (np.sort(self.dt_first), self.dt_second + self.t_rev)))
+        reference.track_classic()
+
+        self._assert_voltage_close(
+            music.induced_voltage,
+            reference.induced_voltage[self.n_macroparticles:])
+        self._assert_voltage_close(
+            music.beam.dE, reference.beam.dE[self.n_macroparticles:])
+
+    def test_batch_mode(self):
+
+        music = self._music(self.dt_first, batch_mode=True)
+        music.track_py()
+        music.beam.dt = self.dt_second.copy()
+        music.track_py_multi_turn()
+
+        reference = self._music(self.dt_first)
+        reference.track_py()
+        reference.beam.dt = self.dt_second.copy()
+        reference.track_py_multi_turn()
+
+        self._assert_voltage_close(music.induced_voltage,
+                                   reference.induced_voltage)
+        self._assert_voltage_close(music.beam.dE, reference.beam.dE)
+
+    def test_parallel_scan(self):
+
+        time_differences = np.diff(np.sort(self.dt_first))
+        exp_cos, exp_sin = musicModule._music_terms(
+            time_differences, 3e8, 6e8)
+        parameters = (-1e3, -0.5, -2., 0.3, 0.5)
+
+        voltage = np.zeros(len(time_differences))
+        dE = np.zeros(len(time_differences))
+        state = musicModule._music_scan_parallel(
+            exp_cos, exp_sin, dE, voltage, *parameters, 1.0, 0.0, 7)
+
+        reference_voltage = np.zeros(len(time_differences))
+        reference_dE = np.zeros(len(time_differences))
+        reference_state = musicModule._music_scan(
+            exp_cos, exp_sin, reference_dE, reference_voltage, *parameters,
+            1.0, 0.0)
+
+        self._assert_voltage_close(voltage, reference_voltage)
+        self._assert_voltage_close(dE, reference_dE)
+        np.testing.assert_allclose(state, reference_state, rtol=1e-7)
+
+    def test_single_precision(self):
+
+        music = self._music(self.dt_first, dtype=np.float32)
+        music.track_py()
+        reference = self._music(self.dt_first)
+        reference.track_py()
+
+        self.assertEqual(music.induced_voltage.dtype, np.float32)
+        self.assertEqual(music._time_differences.dtype, np.float32)
+        np.testing.assert_allclose(
+            music.induced_voltage, reference.induced_voltage, rtol=1e-4,
+            atol=1e-4*np.max(np.abs(reference.induced_voltage)))
+
+    def test_dtype_arguments(self):
+
+        for dtype in ['float32', np.dtype('float32'), np.float32]:
+            music = self._music(self.dt_first, dtype=dtype,
+                                voltage_dtype=dtype)
+            self.assertIs(music.dtype, np.float32)
+            self.assertIs(music.voltage_dtype, np.float32)
+            self.assertIsInstance(music.alpha, np.float32)
+
+    def test_compiled_recurrence_without_numba(self):
+
+        music = self._music(self.dt_first)
+        with mock.patch.object(musicModule, '_HAS_NUMBA', False):
+            music.track_py()
+            music.beam.dt = self.dt_second.copy()
+            music.track_py_multi_turn()
+
+        reference = self._music(self.dt_first)
+        reference.track_py()
+        reference.beam.dt = self.dt_second.copy()
+        reference.track_py_multi_turn()
+
+        self._assert_voltage_close(music.induced_voltage,
+                                   reference.induced_voltage)
+        self._assert_voltage_close(music.beam.dE, reference.beam.dE)
+
+    def test_voltage_storage_type(self):
+
+        music = self._music(self.dt_first, voltage_dtype=np.float32)
+        music.track_py()
+        reference = self._music(self.dt_first)
+        reference.track_py()
+
+        self.assertEqual(music.induced_voltage.dtype, np.float32)
+        self.assertEqual(music.induced_voltage_f64().dtype, np.float64)
+        np.testing.assert_allclose(
+            music.induced_voltage_f64(), reference.induced_voltage,
+            rtol=1e-6, atol=1e-6*np.max(np.abs(reference.induced_voltage)))
+        # The particles are kicked with the voltage before rounding
+        self._assert_voltage_close(music.beam.dE, reference.beam.dE)
+
+    def test_voltage_storage_type_cpp(self):
+
+        music = self._music(self.dt_first, voltage_dtype=np.float32)
+        with self.assertRaises(TypeError):
+            music.track_cpp()
+        with self.assertRaises(TypeError):
+            music.track_cpp_multi_turn()
+
+    def test_track_cpp_against_py(self):
+
+        music = self._music(self.dt_first)
+        music.track_cpp()
+        reference = self._music(self.dt_first)
+        reference.track_py()
+
+        np.testing.assert_equal(music.beam.dt, reference.beam.dt)
+        self._assert_voltage_close(music.induced_voltage,
+                                   reference.induced_voltage)
+        self._assert_voltage_close(music.beam.dE, reference.beam.dE)
+
+    def test_track_cpp_multi_turn_against_py(self):
+
+        music = self._music(self.dt_first)
+        music.track_cpp()
+        music.beam.dt = self.dt_second.copy()
+        music.track_cpp_multi_turn()
+
+        reference = self._music(self.dt_first)
+        reference.track_py()
+        reference.beam.dt = self.dt_second.copy()
+        reference.track_py_multi_turn()
+
+        self._assert_voltage_close(music.induced_voltage,
+                                   reference.induced_voltage)
+        self._assert_voltage_close(music.beam.dE, reference.beam.dE)
+
+    def test_track_py_after_multi_turn_against_cpp(self):
+
+        music = self._music(self.dt_first)
+        music.track_py()
+        music.beam.dt = self.dt_second.copy()
+        music.track_py_multi_turn()
+        music.beam.dE = np.zeros(self.n_macroparticles)
+        music.track_py()
+
+        reference = self._music(self.dt_first)
+        reference.track_cpp()
+        reference.beam.dt = self.dt_second.copy()
+        reference.track_cpp_multi_turn()
+        reference.beam.dE = np.zeros(self.n_macroparticles)
+        reference.track_cpp()
+
+        # The first particle is kicked with the voltage stored for it
+        self.assertAlmostEqual(music.beam.dE[0], music.induced_voltage[0])
+        self.assertAlmostEqual(music.induced_voltage[0],
+                               reference.induced_voltage[0])
+        self._assert_voltage_close(music.beam.dE, reference.beam.dE)
+
+
+if __name__ == '__main__':
+
+    unittest.main()